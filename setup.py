@@ -0,0 +1,19 @@
+# Optional: compile the Brain Core with mypyc (pip install mypy)
+#
+#   python setup.py build_ext --inplace
+#
+# This drops a brain_core.*.so next to src/brain_core.py. Importing
+# brain_core from src/ then picks up the compiled module (extension modules
+# can't be run with -m, so call main() explicitly):
+#
+#   cd src && python -c "import brain_core; brain_core.main()" --broker ...
+#
+# `python src/brain_core.py` still runs the plain source.
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name="x32-brain-core",
+    package_dir={"": "src"},
+    ext_modules=mypycify(["src/brain_core.py"]),
+)
@@ -1,10 +1,17 @@
+import os
 import json
 import time
 import math
+import socket
 import logging
+import queue
+import threading
+import collections
 import argparse
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
+import numpy as np
+import orjson
 import paho.mqtt.client as mqtt
 
 # Logging
@@ -14,6 +21,17 @@ logger = logging.getLogger("BrainCore")
 # Constants
 CONFIG_PATH = "../config/x32_map.json" # Relative from src/
 TARGET_BUS_IDX = [11, 12] # Default, can be overridden by config
+COMMAND_FLUSH_INTERVAL = 0.02 # Coalesce for at most 20ms after the first queued command
+COMMAND_FLUSH_MAX = 64 # Flush early once this many commands are queued
+FADER_SEND_THRESHOLD = 0.005 # ~0.5dB near unity; smaller moves are not re-sent
+FULL_REFRESH_INTERVAL = 10.0 # Seconds between re-sends of every automated level (repairs lost batches/console recalls)
+# Channel groups as integer codes for the SoA arrays
+GROUP_IGNORE, GROUP_DRUMS, GROUP_BAND, GROUP_VOCALS, GROUP_SPEECH = range(5)
+GROUP_CODES = {"ignore": GROUP_IGNORE, "drums": GROUP_DRUMS, "band": GROUP_BAND,
+               "vocals": GROUP_VOCALS, "speech": GROUP_SPEECH}
+AUTOMATED_GROUPS = ("drums", "band", "vocals", "speech")
+
+EXACT_FADER_MATH = os.environ.get("X32_EXACT_FADER_MATH") == "1" # Bypass LUTs (validation)
 
 # X32 Math Helper
 # Behringer X32 Fader Curve (approximate)
@@ -31,34 +49,60 @@ def fader_to_db(fader_val):
     else:
         return -90.0 # Shutdown/Inf
 
-def db_to_fader(db_val):
-    if db_val >= -10.0:
-        return (db_val + 30.0) / 40.0
-    elif db_val >= -30.0:
-        return (db_val + 50.0) / 80.0
-    elif db_val >= -60.0:
-        return (db_val + 70.0) / 160.0
-    else:
-        return 0.0
+def db_to_fader_vec(db_vals):
+    # Same piecewise curve as fader_to_db (inverse), evaluated for all channels at once
+    return np.select(
+        [db_vals >= -10.0, db_vals >= -30.0, db_vals >= -60.0],
+        [(db_vals + 30.0) / 40.0, (db_vals + 50.0) / 80.0, (db_vals + 70.0) / 160.0],
+        default=0.0,
+    )
+
+# Lookup table for the fader curve, built once at import
+# 100 bins per dB over -90..+10 (float64, so on-grid targets like -4dB map to exactly 0.65)
+DB_LUT_MIN = -90.0
+DB_LUT_BINS_PER_DB = 100
+DB_LUT_SIZE = 100 * DB_LUT_BINS_PER_DB
+
+DB_TO_FADER_LUT = db_to_fader_vec(DB_LUT_MIN + np.arange(DB_LUT_SIZE) / DB_LUT_BINS_PER_DB)
+
+def db_to_fader_lut(db_vals):
+    idx = np.rint((np.asarray(db_vals) - DB_LUT_MIN) * DB_LUT_BINS_PER_DB).astype(np.int32)
+    return DB_TO_FADER_LUT[np.clip(idx, 0, DB_LUT_SIZE - 1)]
+
+db_to_fader = db_to_fader_vec if EXACT_FADER_MATH else db_to_fader_lut
 
 class ChannelStrip:
-    def __init__(self, channel_id, config_data):
-        self.id = channel_id
-        self.name = config_data.get("name", f"Ch {channel_id}")
-        self.group = config_data.get("group", "ignore")
-        self.priority = config_data.get("priority", "none")
+    # Fields are annotated so mypyc (see setup.py) can compile them to native attributes
+    def __init__(self, channel_id: str, config_data: Dict[str, Any]) -> None:
+        self.id: str = channel_id
+        self.name: str = config_data.get("name", f"Ch {channel_id}")
+        self.group: str = config_data.get("group", "ignore")
+        self.priority: str = config_data.get("priority", "none")
+        self.idx: int = int(channel_id) - 1 # Position in BrainCore's SoA arrays (and in telemetry)
         
-        self.current_dbfs = -90.0
-        self.current_fader_level = 0.0 # 0.0 to 1.0 (Send level to Bus)
-        self.target_fader_level = 0.75 # Default 0dB
+        # Send level to Bus 11, built once (ch id "1" -> "01")
+        self.osc_address: str = f"/ch/{int(channel_id):02d}/mix/11/level"
         
-        self.is_overridden = False
-        self.override_end_time = 0
+        self.current_fader_level: float = 0.0 # 0.0 to 1.0 (Send level to Bus)
+        self.target_fader_level: float = 0.75 # Default 0dB
+        self.last_sent_fader: float = -1.0 # Nothing sent yet
+        
+        self.is_overridden: bool = False
+        self.override_end_time: float = 0.0 # time.monotonic() seconds
 
 class BrainCore:
-    def __init__(self, broker_ip, config_file):
+    def __init__(self, broker_ip: str, config_file: str) -> None:
         self.broker_ip = broker_ip
         self.channels: Dict[str, ChannelStrip] = {}
+        
+        # SoA views of the channel map, built in load_config.
+        # Slot i is channel i+1, same layout as the telemetry payload.
+        self.by_group: Dict[str, List[ChannelStrip]] = {}
+        self.music_mask = np.zeros(0, dtype=bool)
+        self.vocals_mask = np.zeros(0, dtype=bool)
+        self.speech_mask = np.zeros(0, dtype=bool)
+        self.current_dbfs = np.zeros(0)
+        
         self.config = self.load_config(config_file)
         
         # MQTT
@@ -68,10 +112,25 @@ class BrainCore:
         
         self.running = True
         
+        # Incoming (topic, payload) pairs, handled by process_loop off the paho network thread
+        self._rx_q: queue.SimpleQueue = queue.SimpleQueue()
+        
+        # Outgoing OSC commands, coalesced into one MQTT publish by flush_loop
+        self._cmd_q: collections.deque = collections.deque()
+        self._flush_evt = threading.Event() # Commands queued
+        self._flush_full_evt = threading.Event() # COMMAND_FLUSH_MAX reached, don't wait out the window
+        
         # State
         self.speech_active = False # Gate for Ducking
+        self.vocals_in_deadband = np.zeros(len(self.current_dbfs), dtype=bool)
+        
+        # Set when telemetry changed something run_mixing_logic acts on, or by
+        # refresh_all / start_override. Cleared after each mixing pass.
+        self.channels_dirty = True
+        self.override_count = 0 # Channels with is_overridden set; see start_override
+        self.last_full_refresh = time.monotonic()
 
-    def load_config(self, path):
+    def load_config(self, path: str) -> Dict[str, Any]:
         try:
             with open(path, 'r') as f:
                 data = json.load(f)
@@ -80,6 +139,8 @@ class BrainCore:
                 # Initialize channels
                 for ch_id, ch_data in data.get("channels", {}).items():
                     self.channels[ch_id] = ChannelStrip(ch_id, ch_data)
+                
+                self.build_channel_arrays()
                     
                 global TARGET_BUS_IDX
                 TARGET_BUS_IDX = data.get("target_bus", [11, 12])
@@ -89,123 +150,244 @@ class BrainCore:
             logger.error(f"Failed to load config: {e}")
             return {}
 
+    def build_channel_arrays(self) -> None:
+        n = max((ch.idx + 1 for ch in self.channels.values()), default=0)
+        self.by_group = {}
+        codes = np.full(n, GROUP_IGNORE, dtype=np.int8) # Unmapped slots are ignored
+        
+        for ch in sorted(self.channels.values(), key=lambda ch: ch.idx):
+            self.by_group.setdefault(ch.group, []).append(ch)
+            codes[ch.idx] = GROUP_CODES.get(ch.group, GROUP_IGNORE)
+        
+        # Group membership never changes after load, so the masks are built once
+        self.music_mask = (codes == GROUP_DRUMS) | (codes == GROUP_BAND)
+        self.vocals_mask = codes == GROUP_VOCALS
+        self.speech_mask = codes == GROUP_SPEECH
+        self.current_dbfs = np.full(n, -90.0)
+
     def on_connect(self, client, userdata, flags, rc, properties=None):
         logger.info(f"Connected to MQTT Broker ({rc})")
+        
+        # Small frames: don't let Nagle hold them back waiting for an ACK
+        sock = client.socket()
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
+        # Fresh session: the console may not have our last levels anymore
+        self.refresh_all()
+        
         client.subscribe("x32/telemetry")
         client.subscribe("x32/status/fader/#") # Hypothetical topic for manual moves if reported
 
     def on_message(self, client, userdata, msg):
-        topic = msg.topic
+        # Runs on paho's network thread: just hand off, so reads never wait on mixing
+        self._rx_q.put_nowait((msg.topic, msg.payload))
+
+    def handle_message(self, topic: str, raw: bytes) -> None:
+        # x32/status/fader/# is subscribed but not acted on yet
         try:
-            payload = json.loads(msg.payload.decode())
-            
             if topic == "x32/telemetry":
-                self.process_telemetry(payload)
+                # Packed little-endian float32 dBFS, one per channel
+                levels = np.frombuffer(raw, dtype='<f4')
+                self.process_telemetry(levels)
                 
         except Exception as e:
             logger.error(f"Error processing message on {topic}: {e}")
 
-    def process_telemetry(self, levels: Dict[str, float]):
-        # Update current levels
-        max_speech_db = -90.0
-        
-        for ch_id, db_val in levels.items():
-            if ch_id in self.channels:
-                self.channels[ch_id].current_dbfs = db_val
-                
-                # Check Speech Gate
-                if self.channels[ch_id].group == "speech" and db_val > -35.0:
-                    max_speech_db = max(max_speech_db, db_val)
+    def process_loop(self) -> None:
+        while self.running:
+            try:
+                pending = [self._rx_q.get(timeout=1.0)]
+            except queue.Empty:
+                continue
+            
+            # Drain whatever piled up while the last pass ran
+            while True:
+                try:
+                    pending.append(self._rx_q.get_nowait())
+                except queue.Empty:
+                    break
+            
+            # Only the newest telemetry frame matters; stale ones are dropped
+            # instead of replayed, so a slow pass can't build up latency
+            latest_telemetry = None
+            for topic, raw in pending:
+                if topic == "x32/telemetry":
+                    latest_telemetry = raw
+                else:
+                    self.handle_message(topic, raw)
+            
+            if latest_telemetry is not None:
+                self.handle_message("x32/telemetry", latest_telemetry)
 
-        # Determine Ducking State
-        self.speech_active = (max_speech_db > -35.0)
+    def process_telemetry(self, levels: np.ndarray) -> None:
+        # Update current levels (same channel layout, straight copy)
+        # Channels missing from a short payload keep their last value
+        n = min(len(levels), len(self.current_dbfs))
+        self.current_dbfs[:n] = levels[:n]
+        
+        # Determine Ducking State (Speech Gate)
+        speech_mask = self.speech_mask[:n] & (levels[:n] > -35.0)
+        speech_active = bool(speech_mask.any())
+        if speech_active != self.speech_active:
+            self.speech_active = speech_active
+            self.channels_dirty = True
+        
+        # Vocals: Auto-Leveling Logic
+        # Target: -18dBFS RMS
+        # If current < -18, boost. If > -18, cut.
+        # Simple P-controller
+        error = -18.0 - self.current_dbfs
+        
+        # Deadband: good enough, leave the channel alone
+        in_deadband = self.vocals_mask & (np.abs(error) < 2.0)
+        if not np.array_equal(in_deadband, self.vocals_in_deadband):
+            self.vocals_in_deadband = in_deadband
+            self.channels_dirty = True
+        
+        # Periodic full refresh: dedup alone would never repair a lost batch
+        # or a level changed at the console (scene recall, edge/console restart)
+        if time.monotonic() - self.last_full_refresh >= FULL_REFRESH_INTERVAL:
+            self.refresh_all()
         
         # Run Mixing Logic
         self.run_mixing_logic()
 
-    def run_mixing_logic(self):
+    def refresh_all(self) -> None:
+        """Forget what was sent so the next mixing pass re-sends every automated level"""
+        for ch in self.channels.values():
+            ch.last_sent_fader = -1.0
+        self.last_full_refresh = time.monotonic()
+        self.channels_dirty = True
+
+    def start_override(self, ch: ChannelStrip, duration: float) -> None:
+        """Pause automation on a channel after a manual fader move"""
+        if not ch.is_overridden:
+            ch.is_overridden = True
+            self.override_count += 1
+        ch.override_end_time = time.monotonic() + duration
+        self.channels_dirty = True
+
+    def run_mixing_logic(self) -> None:
+        # Nothing changed since the last pass, so there is nothing new to send.
+        # Anything that must re-send (refresh_all, reconnect) sets channels_dirty;
+        # overrides keep the pass running so their expiry is noticed.
+        if not self.channels_dirty and self.override_count == 0:
+            return
+        self.channels_dirty = False
+        
         # 1. Apply Ducking to Music (Drums/Band)
         duck_amount = -4.0 if self.speech_active else 0.0
         # Convert dB reduction to linear multiplier? Or just offset target?
         # X32 faders are log. We will adjust the Target DB, then convert to Fader 0-1
         
-        # 2. Iterate channels
-        commands = []
+        # 2. Compute targets for all channels at once (Logic by Group)
+        # Music: Apply Ducking (assuming we want them at 0dB normally)
+        # Vocals/Speech: Unity send
+        target_db = np.where(self.music_mask, 0.0 + duck_amount, 0.0)
         
-        for ch in self.channels.values():
-            if ch.is_overridden:
-                if time.time() > ch.override_end_time:
-                    ch.is_overridden = False
-                    logger.info(f"Override ended for {ch.name}")
-                else:
-                    continue # Skip automation
-            
-            # Logic by Group
-            new_target_db = 0.0 # Default send level (Unity)
-            
-            if ch.group == "drums" or ch.group == "band":
-                # Apply Ducking
-                new_target_db = 0.0 + duck_amount # Assuming we want them at 0dB normally
+        # Vocals: Auto-Leveling (deadband computed in process_telemetry)
+        in_deadband = self.vocals_in_deadband
+        
+        # Restrict gain to reasonable limits (e.g. +10dB to -10dB from Unity)
+        # This is a simplification. Real auto-leveling needs more state (current gain).
+        # Since we don't know the CURRENT fader pos from the console in this loop 
+        # (unless we track it via separate OSC feedback which is complex),
+        # We will assume nominal start and nudge.
+        # FOR SAFETY in this v1: We just set a fixed safe level.
+        
+        # Convert to Fader 0.0-1.0
+        fader_vals = db_to_fader(target_db)
+        
+        # 3. Iterate automated channels, group by group
+        commands: List[Dict[str, Any]] = []
+        now = time.monotonic() # One clock read per tick
+        
+        for group in AUTOMATED_GROUPS:
+            for ch in self.by_group.get(group, ()):
+                i = ch.idx
+                if ch.is_overridden:
+                    if now > ch.override_end_time:
+                        ch.is_overridden = False
+                        self.override_count -= 1
+                        ch.last_sent_fader = -1.0 # Fader was moved by hand: restore it
+                        logger.info(f"Override ended for {ch.name}")
+                    else:
+                        continue # Skip automation
                 
-            elif ch.group == "vocals":
-                # Auto-Leveling Logic
-                # Target: -18dBFS RMS
-                # If current < -18, boost. If > -18, cut.
-                # Simple P-controller
-                error = -18.0 - ch.current_dbfs
+                if in_deadband[i]:
+                    continue
+
+                # For sends, the address is typically /ch/01/mix/01/level (for mixbus 1)
+                # But wait, user said "Bus 11 e 12 (Stereo Linked)".
+                # When linked, usually sending to odd bus controls the level for both? 
+                # Or depends on "sends on fader" logic. usually /ch/01/mix/11/level works.
                 
-                # Deadband
-                if abs(error) < 2.0:
-                    continue # Good enough
+                fader_val = float(fader_vals[i])
                 
-                # Restrict gain to reasonable limits (e.g. +10dB to -10dB from Unity)
-                # This is a simplification. Real auto-leveling needs more state (current gain).
-                # Since we don't know the CURRENT fader pos from the console in this loop 
-                # (unless we track it via separate OSC feedback which is complex),
-                # We will assume nominal start and nudge.
-                # FOR SAFETY in this v1: We just set a fixed safe level.
-                new_target_db = 0.0
+                # Rate limiting: Only send if changed significantly
+                if abs(fader_val - ch.last_sent_fader) < FADER_SEND_THRESHOLD:
+                    continue
+                ch.last_sent_fader = fader_val
                 
-            elif ch.group == "speech":
-                new_target_db = 0.0 # Keep speech at Unity send
-            
-            else:
-                continue
+                # Construct OSC Command (Send to Bus 11)
+                commands.append({"address": ch.osc_address, "args": [fader_val]})
 
-            # Convert to Fader 0.0-1.0
-            # For sends, the address is typically /ch/01/mix/01/level (for mixbus 1)
-            # But wait, user said "Bus 11 e 12 (Stereo Linked)".
-            # When linked, usually sending to odd bus controls the level for both? 
-            # Or depends on "sends on fader" logic. usually /ch/01/mix/11/level works.
-            
-            fader_val = db_to_fader(new_target_db)
-            
-            # Rate limiting / Optimization: Only send if changed significantly
-            # (Skipped for brevity, but crucial for real deploy)
-            
-            # Construct OSC Command
-            # ch.id is "1", "2"... needs "01", "02"
-            ch_str = f"{int(ch.id):02d}"
-            
-            # Send to Bus 11
-            address = f"/ch/{ch_str}/mix/11/level"
-            commands.append({"address": address, "args": [float(fader_val)]})
+        # Queue for the next batch publish
+        if commands:
+            self._cmd_q.extend(commands)
+            self._flush_evt.set()
+            if len(self._cmd_q) >= COMMAND_FLUSH_MAX:
+                self._flush_full_evt.set()
 
+    def flush_commands(self) -> None:
+        # Drain the queue; if a channel was queued more than once, only its latest level is sent
+        pending: Dict[str, Dict[str, Any]] = {}
+        while self._cmd_q:
+            cmd = self._cmd_q.popleft()
+            pending[cmd["address"]] = cmd
+        
         # Send Batch Command
-        if commands:
-            for cmd in commands:
-                self.client.publish("x32/commands", json.dumps(cmd))
+        # One MQTT frame per flush instead of one per channel.
+        # QoS 0 on purpose: a lost batch is repaired by the next full refresh
+        # (FULL_REFRESH_INTERVAL, or on reconnect), so per-message broker acks
+        # would only add round-trips.
+        if pending:
+            self.client.publish("x32/commands", orjson.dumps({"batch": list(pending.values())}), qos=0, retain=False)
 
-    def start(self):
+    def flush_loop(self) -> None:
+        while self.running:
+            # Sleep until something is queued, then give other producers up to
+            # COMMAND_FLUSH_INTERVAL to join the same batch
+            self._flush_evt.wait()
+            self._flush_full_evt.wait(COMMAND_FLUSH_INTERVAL)
+            self._flush_evt.clear()
+            self._flush_full_evt.clear()
+            try:
+                self.flush_commands()
+            except Exception as e:
+                logger.error(f"Failed to publish commands: {e}")
+
+    def start(self) -> None:
         logger.info("Starting Brain Core...")
+        
+        self.process_thread = threading.Thread(target=self.process_loop, daemon=True)
+        self.process_thread.start()
+        
+        self.flush_thread = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flush_thread.start()
+        
         try:
             self.client.connect(self.broker_ip, 1883, 60)
             self.client.loop_forever()
         except KeyboardInterrupt:
             logger.info("Stopping Brain Core")
+            self.running = False
+            self._flush_evt.set()
+            self._flush_full_evt.set()
             self.client.disconnect()
 
-if __name__ == "__main__":
+def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", default="config/x32_map.json", help="Path to config file")
     parser.add_argument("--broker", default="localhost", help="MQTT Broker")
@@ -213,3 +395,6 @@ if __name__ == "__main__":
     
     brain = BrainCore(args.broker, args.config)
     brain.start()
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
-import cls
-import json
+import os
+import gc
 import time
 import math
 import threading
@@ -11,9 +11,15 @@ from typing import Dict, List, Optional
 
 import pyaudio
 import numpy as np
+import orjson
 import paho.mqtt.client as mqtt
 from pythonosc.udp_client import SimpleUDPClient
 
+try:
+    from numba import njit, prange
+except ImportError: # Optional: falls back to plain NumPy
+    njit = None
+
 # Configuration
 # TODO: Move to a config file or env vars if needed
 MQTT_BROKER = "localhost" # Or IP of the Brain/Mosquitto
@@ -24,11 +30,34 @@ SAMPLE_RATE = 48000
 CHUNK_SIZE = 1024 # Buffer size
 CHANNELS = 32
 TELEMETRY_INTERVAL = 0.2 # 200ms
+AUDIO_RT_PRIORITY = 10 # SCHED_FIFO priority for the audio thread (Linux, needs root/CAP_SYS_NICE)
+AUDIO_CPU = None # Pin the audio thread to this CPU (Linux), None = don't pin
+GC_COLLECT_INTERVAL = 5 # Seconds between young-generation collections (automatic GC is off)
+GC_FULL_COLLECT_EVERY = 12 # Full collection every N intervals (~1 min)
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("EdgeNode")
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def rms_dbfs(buf_i32, out_db):
+        # Single pass over the (frames, channels) int32 buffer; raw samples are
+        # squared and summed in float64 and only the 32 sums are normalized.
+        # (int64 can't hold even two full-scale squares: 2 * 2^62 overflows.)
+        # Same math as the NumPy fallback, so both read identical levels.
+        # 10*log10(mean(x^2)) == 20*log10(rms)
+        frames, channels = buf_i32.shape
+        scale = 1.0 / (frames * 2.0**62) # (2^31)^2 full scale
+        for c in prange(channels):
+            acc = 0.0
+            for f in range(frames):
+                x = np.float64(buf_i32[f, c])
+                acc += x * x
+            out_db[c] = 10.0 * np.log10(acc * scale + 1e-18)
+else:
+    rms_dbfs = None
+
 class X32EdgeNode:
     def __init__(self, mqtt_broker, mqtt_port, x32_ip, x32_port):
         self.mqtt_broker = mqtt_broker
@@ -51,21 +80,53 @@ class X32EdgeNode:
         
         # State
         self.last_telemetry_time = 0
-        self.levels = [0.0] * CHANNELS
+        self._tele_evt = threading.Event() # Set by audio_callback when telemetry is due
+        
+        # Reused telemetry payload: packed little-endian float32, channel 1 first
+        self._tele_buf = bytearray(CHANNELS * 4)
+        self._tele_view = np.frombuffer(self._tele_buf, dtype='<f4')
+        self._out_db = np.full(CHANNELS, -90.0) # Written in place by audio_callback
+        # Scratch for the NumPy path, reused every callback
+        self._scratch = np.empty((CHUNK_SIZE, CHANNELS), dtype=np.float64)
+        self._sumsq = np.empty(CHANNELS, dtype=np.float64)
+        self.levels = self._out_db
+        
+        # Compile the Numba kernel (and start its thread pool) now, not on the
+        # first audio callback. The input must be read-only like the callback's
+        # np.frombuffer view, or Numba compiles a second signature later.
+        # Output goes to a throwaway array so self.levels keeps its -90 default.
+        if rms_dbfs is not None:
+            warmup = np.frombuffer(bytes(CHUNK_SIZE * CHANNELS * 4), dtype=np.int32)
+            rms_dbfs(warmup.reshape((CHUNK_SIZE, CHANNELS)), np.empty_like(self._out_db))
 
     def on_mqtt_connect(self, client, userdata, flags, rc, properties=None):
         logger.info(f"Connected to MQTT Broker with code {rc}")
+        
+        # Small frames: don't let Nagle hold them back waiting for an ACK
+        sock = client.socket()
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
         client.subscribe("x32/commands")
 
     def on_mqtt_message(self, client, userdata, msg):
         try:
-            payload = json.loads(msg.payload.decode())
-            address = payload.get("address")
-            args = payload.get("args")
+            payload = orjson.loads(msg.payload)
             
-            if address:
-                logger.debug(f"Forwarding OSC: {address} {args}")
-                self.osc_client.send_message(address, args)
+            # Brain sends {"batch": [cmd, ...]}, one frame per mixing tick.
+            # A bare {"address": ..., "args": ...} is still accepted.
+            if "batch" in payload:
+                commands = payload["batch"]
+            else:
+                commands = [payload]
+            
+            for cmd in commands:
+                address = cmd.get("address")
+                args = cmd.get("args")
+                
+                if address:
+                    logger.debug(f"Forwarding OSC: {address} {args}")
+                    self.osc_client.send_message(address, args)
         except Exception as e:
             logger.error(f"Error processing MQTT message: {e}")
 
@@ -83,38 +144,58 @@ class X32EdgeNode:
             logger.error(f"Audio buffer size mismatch. Got {len(audio_data)}, expected {frame_count * CHANNELS}")
             return (None, pyaudio.paContinue)
 
-        # Calculate RMS for each channel
-        # 2^31 is max value for int32
-        # Normalize to -1.0 to 1.0
-        normalized_data = audio_data / 2147483648.0 
-        
-        # Calculate RMS: sqrt(mean(x^2))
-        # axis=0 calculates mean across frames for each channel
-        rms_values = np.sqrt(np.mean(normalized_data**2, axis=0))
-        
-        # Convert to dBFS
-        # Add epsilon to avoid log(0)
-        db_values = 20 * np.log10(rms_values + 1e-9)
+        # Calculate RMS (dBFS) for each channel into self._out_db,
+        # which is also what the telemetry loop reads (no list copy)
+        if rms_dbfs is not None:
+            rms_dbfs(audio_data, self._out_db)
+        else:
+            # Convert into the preallocated float64 scratch (einsum with dtype=
+            # would allocate a full-size cast buffer), then sum of squares per channel
+            if frame_count > self._scratch.shape[0]:
+                self._scratch = np.empty((frame_count, CHANNELS), dtype=np.float64)
+            scratch = self._scratch[:frame_count]
+            np.copyto(scratch, audio_data)
+            np.einsum('fc,fc->c', scratch, scratch, out=self._sumsq)
+            
+            # mean(x^2) normalized to full scale (2^31 squared = 2^62)
+            self._sumsq *= 1.0 / (frame_count * 2.0**62)
+            
+            # dBFS = 10*log10(mean(x^2)) == 20*log10(rms)
+            # Add epsilon to avoid log(0)
+            self._sumsq += 1e-18
+            np.log10(self._sumsq, out=self._sumsq)
+            
+            # Single write, so the telemetry thread never sees a half-finished array
+            np.multiply(self._sumsq, 10.0, out=self._out_db)
         
-        # Store for telemetry loop
-        self.levels = db_values.tolist()
+        # Wake the telemetry thread once per interval
+        now = time.monotonic()
+        if now - self.last_telemetry_time >= TELEMETRY_INTERVAL:
+            self.last_telemetry_time = now
+            self._tele_evt.set()
         
         return (None, pyaudio.paContinue)
 
     def telemetry_loop(self):
         while self.running:
-            current_time = time.time()
-            if current_time - self.last_telemetry_time >= TELEMETRY_INTERVAL:
-                # Create map "1": level, "2": level...
-                telemetry_data = {str(i+1): lvl for i, lvl in enumerate(self.levels)}
-                
-                try:
-                    self.mqtt_client.publish("x32/telemetry", json.dumps(telemetry_data))
-                    self.last_telemetry_time = current_time
-                except Exception as e:
-                    logger.error(f"Failed to publish telemetry: {e}")
+            # Timeout only so a stalled stream doesn't block shutdown
+            if not self._tele_evt.wait(timeout=1.0):
+                continue
+            self._tele_evt.clear()
+            
+            if not self.running:
+                break
+            
+            # Pack into the preallocated buffer (128 bytes for 32ch).
+            # paho copies the payload into the packet inside publish(), so the
+            # buffer can be overwritten on the next pass.
+            np.copyto(self._tele_view, self.levels, casting='same_kind')
             
-            time.sleep(0.05) # Sleep briefly to yield CPU
+            # QoS 0: a dropped frame is replaced by the next one 200ms later (levels are sent every time)
+            try:
+                self.mqtt_client.publish("x32/telemetry", self._tele_buf, qos=0, retain=False)
+            except Exception as e:
+                logger.error(f"Failed to publish telemetry: {e}")
 
     def xremote_loop(self):
         """Periodically send /xremote to receive OSC updates from console (fader moves)"""
@@ -125,6 +206,49 @@ class X32EdgeNode:
             except Exception as e:
                 logger.error(f"Failed to send /xremote: {e}")
 
+    def gc_loop(self):
+        """Run garbage collection off the audio path while automatic GC is disabled"""
+        count = 0
+        while self.running:
+            time.sleep(GC_COLLECT_INTERVAL)
+            count += 1
+            if count % GC_FULL_COLLECT_EVERY == 0:
+                gc.collect()
+            else:
+                gc.collect(0)
+
+    def enter_realtime(self):
+        """Switch the calling thread to SCHED_FIFO (and pin it if AUDIO_CPU is set).
+        Threads it creates inherit this, so call it right before the audio stream starts.
+        Returns the previous settings for restore_scheduling."""
+        saved = {}
+        
+        if AUDIO_CPU is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                saved["affinity"] = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, {AUDIO_CPU})
+            except OSError as e:
+                logger.warning(f"Could not pin audio thread to CPU {AUDIO_CPU}: {e}")
+        
+        if hasattr(os, "sched_setscheduler"):
+            try:
+                policy, param = os.sched_getscheduler(0), os.sched_getparam(0)
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(AUDIO_RT_PRIORITY))
+                saved["scheduler"] = (policy, param)
+            except OSError as e:
+                logger.warning(f"Could not set SCHED_FIFO (run as root?): {e}")
+        
+        return saved
+
+    def restore_scheduling(self, saved):
+        try:
+            if "scheduler" in saved:
+                os.sched_setscheduler(0, *saved["scheduler"])
+            if "affinity" in saved:
+                os.sched_setaffinity(0, saved["affinity"])
+        except OSError as e:
+            logger.warning(f"Could not restore scheduling: {e}")
+
     def start(self):
         self.running = True
         
@@ -136,7 +260,13 @@ class X32EdgeNode:
             logger.error(f"Could not connect to MQTT: {e}")
             return
 
+        # No automatic GC pauses inside the audio callback; gc_loop collects instead
+        gc.disable()
+        
         # Start Audio Stream
+        # PortAudio's callback thread is created here and inherits the RT settings;
+        # this thread goes back to normal scheduling afterwards
+        saved_sched = self.enter_realtime()
         try:
             # TODO: Add logic to find specific device index by name "X-USB"
             # For now, using default
@@ -152,6 +282,8 @@ class X32EdgeNode:
             logger.error(f"Could not start audio stream: {e}")
             self.stop()
             return
+        finally:
+            self.restore_scheduling(saved_sched)
             
         # Start Threads
         self.telemetry_thread = threading.Thread(target=self.telemetry_loop)
@@ -160,6 +292,9 @@ class X32EdgeNode:
         self.xremote_thread = threading.Thread(target=self.xremote_loop)
         self.xremote_thread.start()
         
+        self.gc_thread = threading.Thread(target=self.gc_loop, daemon=True)
+        self.gc_thread.start()
+        
         logger.info("Edge Node Running. Press Ctrl+C to stop.")
         
         try:
@@ -170,6 +305,7 @@ class X32EdgeNode:
 
     def stop(self):
         self.running = False
+        self._tele_evt.set() # Release the telemetry thread
         logger.info("Stopping...")
         
         if self.stream:
@@ -179,6 +315,8 @@ class X32EdgeNode:
         self.p.terminate()
         self.mqtt_client.loop_stop()
         self.mqtt_client.disconnect()
+        
+        gc.enable()
 
 
 if __name__ == "__main__":